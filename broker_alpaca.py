@@ -1,22 +1,74 @@
-import os, requests
+import os, time, asyncio
+import httpx
+import orjson
 
 BASE = os.getenv("ALPACA_API_BASE_URL", "https://paper-api.alpaca.markets/v2")
 KEY  = os.getenv("ALPACA_KEY_ID")
 SEC  = os.getenv("ALPACA_SECRET_KEY")
-HEAD = {"APCA-API-KEY-ID": KEY, "APCA-API-SECRET-KEY": SEC}
+JSON_HEAD = {"Content-Type": "application/json"}
 
-def account():
-    r = requests.get(f"{BASE}/account", headers=HEAD, timeout=20)
-    r.raise_for_status()
-    return r.json()
+# Account/posities veranderen traag t.o.v. Poe-verkeer: korte cache, één upstream call per burst
+CACHE_TTL = 1.5
+_cache = {}     # key -> (monotonic ts, data)
+_inflight = {}  # key -> (generatie, asyncio.Task van de lopende fetch)
+_gen = 0        # opgehoogd bij elke order; fetches van vóór de order schrijven niet meer in de cache
+
+def make_client(key_id=KEY, secret=SEC):
+    # Eén gedeelde client per proces (via de FastAPI lifespan): keep-alive + HTTP/2 naar Alpaca
+    headers = {"APCA-API-KEY-ID": key_id or "", "APCA-API-SECRET-KEY": secret or ""}
+    # Kleine keep-alive pool die bij Alpaca's rate limits past; HTTP/2 multiplext er bovenop
+    # retries=2 herhaalt alleen mislukte connects (geen dubbele orders)
+    limits = httpx.Limits(max_keepalive_connections=8, max_connections=16, keepalive_expiry=30.0)
+    transport = httpx.AsyncHTTPTransport(http2=True, limits=limits, retries=2)
+    return httpx.AsyncClient(base_url=BASE, headers=headers, transport=transport,
+                             timeout=httpx.Timeout(10.0, connect=3.0))
+
+async def _cached(key, ttl, fetch):
+    # TTL-cache met single-flight: gelijktijdige misses op dezelfde key wachten op één
+    # gedeelde fetch-task en krijgen allemaal hetzelfde resultaat óf dezelfde exception
+    hit = _cache.get(key)
+    if hit and time.monotonic() - hit[0] < ttl:
+        return hit[1]
+    flight = _inflight.get(key)
+    if flight and flight[0] == _gen:
+        task = flight[1]
+    else:
+        task = asyncio.ensure_future(_fill(key, fetch, _gen))
+        _inflight[key] = (_gen, task)
+        task.add_done_callback(lambda t: _done(key, t))
+    # shield: een geannuleerde webhook annuleert niet de fetch van de anderen
+    return await asyncio.shield(task)
+
+async def _fill(key, fetch, gen):
+    data = await fetch()
+    if gen == _gen:
+        _cache[key] = (time.monotonic(), data)
+    return data
 
-def positions():
-    r = requests.get(f"{BASE}/positions", headers=HEAD, timeout=20)
+def _done(key, task):
+    flight = _inflight.get(key)
+    if flight and flight[1] is task:
+        del _inflight[key]
+    if not task.cancelled():
+        task.exception()  # markeer als opgehaald, ook als alle wachters weg zijn
+
+async def _get(client, path):
+    r = await client.get(path)
     r.raise_for_status()
-    return r.json()
+    return orjson.loads(r.content)
+
+async def account(client, ttl=CACHE_TTL):
+    return await _cached("/account", ttl, lambda: _get(client, "/account"))
+
+async def positions(client, ttl=CACHE_TTL):
+    return await _cached("/positions", ttl, lambda: _get(client, "/positions"))
 
-def market_order(symbol="AAPL", qty=1, side="buy", tif="gtc"):
+async def market_order(client, symbol="AAPL", qty=1, side="buy", tif="gtc"):
+    global _gen
     data = {"symbol": symbol, "qty": qty, "side": side, "type": "market", "time_in_force": tif}
-    r = requests.post(f"{BASE}/orders", json=data, headers=HEAD, timeout=20)
+    r = await client.post("/orders", content=orjson.dumps(data), headers=JSON_HEAD)
     r.raise_for_status()
-    return r.json()
+    # account/posities zijn na een order niet meer actueel
+    _gen += 1
+    _cache.clear()
+    return orjson.loads(r.content)
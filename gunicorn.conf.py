@@ -0,0 +1,14 @@
+import multiprocessing
+import os
+
+# Render start command: gunicorn main:app  (dit bestand wordt automatisch geladen)
+bind = f"0.0.0.0:{os.getenv('PORT') or 8000}"
+worker_class = "uvicorn_worker.UvicornWorker"
+
+# Zonder WEB_CONCURRENCY: 2n+1 over de CPU's die dit proces mag gebruiken, maar maximaal 4.
+# In een container ziet cpu_count() (en vaak ook de affinity) de cores van de host, niet de
+# CPU-quota; zonder cap start een kleine instance tientallen workers, elk met eigen
+# Alpaca-pool en cache, en loopt uit het geheugen. Meer nodig? Zet WEB_CONCURRENCY.
+MAX_DEFAULT_WORKERS = 4
+_cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else multiprocessing.cpu_count()
+workers = int(os.getenv("WEB_CONCURRENCY") or min(2 * _cpus + 1, MAX_DEFAULT_WORKERS))
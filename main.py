@@ -1,25 +1,55 @@
 import os
-import json
+import hmac
 import logging
-from typing import Dict, Any, Optional
+from contextlib import asynccontextmanager
+from typing import Dict, Any
 
-import requests
-from fastapi import FastAPI, Request, Header
-from fastapi.responses import JSONResponse
+import httpx
+import orjson
+from fastapi import FastAPI, HTTPException, Request, Response
 
-app = FastAPI()
+import broker_alpaca
 
 # === Config uit env ===
 POE_KEY = os.getenv("KEY") or os.getenv("POE_ACCESS_KEY") or ""
+_POE_KEY_B = POE_KEY.strip().encode()
 MODE = (os.getenv("MODE") or "alpaca_paper").strip()
 ALPACA_API_KEY = (os.getenv("ALPACA_API_KEY") or "").strip()
 ALPACA_SECRET_KEY = (os.getenv("ALPACA_SECRET_KEY") or "").strip()
+_ALPACA_KEYS_OK = bool(ALPACA_API_KEY and ALPACA_SECRET_KEY)
+_MISSING_KEYS_MSG = "⚠️ ALPACA_API_KEY/ALPACA_SECRET_KEY ontbreken in de Render environment."
+
+# Poe berichten zijn klein; alles boven 64 KB wordt geweigerd vóór het parsen
+MAX_BODY_BYTES = 64 * 1024
+
+# Thread/multiprocessing-namen gebruikt geen enkel logformaat hier: niet per record opzoeken.
+# logProcesses blijft aan: gunicorn's error log formatteert %(process)d.
+logging.logThreads = False
+logging.logMultiprocessing = False
+# LOG_LEVEL mag een naam (DEBUG, INFO, ...) of een getal zijn; onbekend -> INFO i.p.v. crash bij import
+_LOG_LEVEL_RAW = (os.getenv("LOG_LEVEL") or "INFO").strip().upper()
+_log_level = int(_LOG_LEVEL_RAW) if _LOG_LEVEL_RAW.isdigit() else logging.getLevelName(_LOG_LEVEL_RAW)
+logging.basicConfig(level=_log_level if isinstance(_log_level, int) else logging.INFO)
+log = logging.getLogger("poe-bot")
 
-# Alpaca endpoints
-ALPACA_ACCOUNT_URL = "https://paper-api.alpaca.markets/v2/account"
+if not isinstance(_log_level, int):
+    log.warning("Onbekend LOG_LEVEL %r; val terug op INFO.", _LOG_LEVEL_RAW)
+
+if not _ALPACA_KEYS_OK:
+    log.warning("ALPACA_API_KEY/ALPACA_SECRET_KEY niet gezet; 'account' geeft een foutmelding.")
 
-logging.basicConfig(level=logging.INFO)
-log = logging.getLogger("poe-bot")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Eén gedeelde Alpaca client per worker, zodat de verbinding hergebruikt wordt.
+    """
+    app.state.alpaca = broker_alpaca.make_client(ALPACA_API_KEY, ALPACA_SECRET_KEY)
+    yield
+    await app.state.alpaca.aclose()
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 def poe_reply(text: str) -> Dict[str, Any]:
@@ -39,20 +69,49 @@ def poe_reply(text: str) -> Dict[str, Any]:
     }
 
 
+def raw_json(body: bytes, status_code: int = 200) -> Response:
+    """
+    Response voor JSON die al geserialiseerd is (zie de vaste antwoorden hieronder).
+    """
+    return Response(body, status_code=status_code, media_type="application/json")
+
+
+# Vaste antwoorden (MODE en teksten veranderen niet tijdens runtime): één keer serialiseren bij import
+_ROOT_BODY = orjson.dumps({"status": "ok", "mode": MODE})
+_HEALTH_BODY = orjson.dumps({"ok": bool(MODE), "mode": MODE})
+_MODE_BODY = orjson.dumps({"mode": MODE})
+_FORBIDDEN_BODY = orjson.dumps({"detail": "Forbidden"})
+_NO_TEXT_BODY = orjson.dumps(poe_reply("Ik heb geen tekst ontvangen. Typ ‘help’ of ‘account’."))
+_HELP_BODY = orjson.dumps(poe_reply(
+    "Beschikbare commando’s:\n"
+    "• account – status van je Alpaca paper account\n"
+    "• help – dit scherm\n"
+    "\nProtip: Als je ‘account’ krijgt met fout, check in Render of ALPACA_API_KEY/ALPACA_SECRET_KEY goed staan."
+))
+
+
 @app.get("/")
-def root():
-    return {"status": "ok", "mode": MODE}
+async def root():
+    return raw_json(_ROOT_BODY)
 
 
 @app.get("/health")
-def health():
-    ok = bool(MODE)
-    return {"ok": ok, "mode": MODE}
+async def health():
+    return raw_json(_HEALTH_BODY)
 
 
 @app.get("/mode")
-def get_mode():
-    return {"mode": MODE}
+async def get_mode():
+    return raw_json(_MODE_BODY)
+
+
+def _key_matches(candidate: str) -> bool:
+    """
+    Constant-time vergelijking met de vooraf ge-encodeerde key. Bewust geen memo/cache:
+    een cache-hit is sneller dan een miss en houdt aangeleverde secrets in het geheugen.
+    """
+    candidate = (candidate or "").strip()
+    return bool(candidate) and hmac.compare_digest(candidate.encode(), _POE_KEY_B)
 
 
 def get_user_text(payload: Dict[str, Any]) -> str:
@@ -60,98 +119,136 @@ def get_user_text(payload: Dict[str, Any]) -> str:
     Poe server-bot payloads hebben meestal messages[-1].content[0].text
     maar we supporten ook simpele {"text":"..."} JSON om lokaal te testen.
     """
+    if not isinstance(payload, dict):
+        return ""
+
     # simpele test payload
-    if "text" in payload and isinstance(payload["text"], str):
-        return payload["text"]
+    text = payload.get("text")
+    if isinstance(text, str):
+        return text
 
     # Poe formaat: {"messages":[{"role":"user","content":[{"type":"text","text":"..."}]}]}
-    try:
-        msgs = payload.get("messages") or []
-        if msgs:
-            last = msgs[-1]
-            content = last.get("content") or []
-            for part in content:
-                if isinstance(part, dict) and part.get("type") == "text":
-                    return str(part.get("text") or "").strip()
-    except Exception:
-        pass
+    # Expliciete checks i.p.v. try/except: dit is het pad van elke request.
+    msgs = payload.get("messages")
+    if not (isinstance(msgs, list) and msgs and isinstance(msgs[-1], dict)):
+        return ""
+    content = msgs[-1].get("content")
+    if isinstance(content, list):
+        # Stopt bij het eerste text-deel; bij Poe is dat normaal content[0]
+        for part in content:
+            if isinstance(part, dict) and part.get("type") == "text":
+                return str(part.get("text") or "").strip()
 
     return ""
 
 
-def alpaca_account_text() -> str:
-    if not (ALPACA_API_KEY and ALPACA_SECRET_KEY):
-        return "⚠️ ALPACA_API_KEY/ALPACA_SECRET_KEY ontbreken in de Render environment."
+async def alpaca_account_text(client: httpx.AsyncClient) -> str:
+    if not _ALPACA_KEYS_OK:
+        return _MISSING_KEYS_MSG
 
-    headers = {
-        "APCA-API-KEY-ID": ALPACA_API_KEY,
-        "APCA-API-SECRET-KEY": ALPACA_SECRET_KEY,
-    }
     try:
-        r = requests.get(ALPACA_ACCOUNT_URL, headers=headers, timeout=10)
-        if r.status_code == 200:
-            data = r.json()
-            status = data.get("status")
-            equity = data.get("equity")
-            cash = data.get("cash")
-            buying_power = data.get("buying_power")
-            return (
-                "📊 Alpaca Paper account\n"
-                f"• Status: {status}\n"
-                f"• Equity: {equity}\n"
-                f"• Cash: {cash}\n"
-                f"• Buying power: {buying_power}"
-            )
-        else:
-            return f"⚠️ Alpaca account call faalde: HTTP {r.status_code} – {r.text[:200]}"
+        data = await broker_alpaca.account(client)
+    except httpx.HTTPStatusError as e:
+        r = e.response
+        return f"⚠️ Alpaca account call faalde: HTTP {r.status_code} – {r.text[:200]}"
     except Exception as e:
         return f"⚠️ Fout bij Alpaca call: {e}"
 
+    status = data.get("status")
+    equity = data.get("equity")
+    cash = data.get("cash")
+    buying_power = data.get("buying_power")
+    return (
+        "📊 Alpaca Paper account\n"
+        f"• Status: {status}\n"
+        f"• Equity: {equity}\n"
+        f"• Cash: {cash}\n"
+        f"• Buying power: {buying_power}"
+    )
+
+
+# === Command handlers ===
+async def _cmd_help(request: Request) -> Response:
+    return raw_json(_HELP_BODY)
+
+
+async def _cmd_account(request: Request) -> Response:
+    return raw_json(orjson.dumps(poe_reply(await alpaca_account_text(request.app.state.alpaca))))
+
+
+# Eerste woord van het bericht -> handler
+_ROUTES = {
+    "help": _cmd_help,
+    "h": _cmd_help,
+    "?": _cmd_help,
+    "account": _cmd_account,
+}
+
 
 @app.post("/webhook")
-async def webhook(
-    request: Request,
-    poe_access_key: Optional[str] = Header(None, convert_underscores=False),
-    authorization: Optional[str] = Header(None),
-    x_poe_access_key: Optional[str] = Header(None, convert_underscores=False),
-):
+async def webhook(request: Request):
     """
     Poe server-bot endpoint.
     - Controleert access key in headers: 'poe-access-key' (voorkeur), of 'x-poe-access-key'.
-    - Parse't het user bericht.
+    - Pas daarna wordt de body gelezen en het user bericht geparsed.
     - Stuurt antwoord in exact Poe-formaat.
     """
-    body = await request.body()
-    try:
-        payload = json.loads(body.decode("utf-8") or "{}")
-    except Exception:
-        payload = {}
-
-    # === KEY check ===
-    supplied = poe_access_key or x_poe_access_key or (authorization or "").replace("Bearer ", "").strip()
-    if POE_KEY:
-        if not supplied or supplied.strip() != POE_KEY.strip():
+    # === KEY check === (vóór het lezen van de body: een 403 kost geen upload/parse)
+    if POE_KEY:  # ruwe waarde: een KEY van alleen spaties sluit alles af i.p.v. auth uit te zetten
+        # Direct uit request.headers: geen FastAPI Header()-dependencies per request
+        # Alleen zover lookups doen als nodig: de eerste header die gezet is wint
+        h = request.headers
+        supplied = (h.get("poe-access-key") or h.get("x-poe-access-key")
+                    or (h.get("authorization") or "").removeprefix("Bearer "))
+        if not _key_matches(supplied):
             # Log veilig (niet de echte KEY printen)
             log.warning("Forbidden: access key mismatch. Received headers: poe-access-key=%s x-poe-access-key=%s auth=%s",
-                        bool(poe_access_key), bool(x_poe_access_key), bool(authorization))
-            return JSONResponse(status_code=403, content={"detail": "Forbidden"})
+                        bool(h.get("poe-access-key")), bool(h.get("x-poe-access-key")), bool(h.get("authorization")))
+            return raw_json(_FORBIDDEN_BODY, status_code=403)
+
+    cl = request.headers.get("content-length")
+    if cl and cl.isdigit() and int(cl) > MAX_BODY_BYTES:
+        raise HTTPException(413, "payload too large")
+
+    # Lege POSTs (health probes, pings) hoeven niet gelezen of geparsed te worden
+    payload = {}
+    if cl != "0":
+        # Streamend lezen: ook een chunked upload zonder Content-Length wordt afgekapt
+        # zodra hij over de limiet gaat, i.p.v. eerst helemaal gebufferd te worden
+        body = bytearray()
+        async for chunk in request.stream():
+            body += chunk
+            if len(body) > MAX_BODY_BYTES:
+                raise HTTPException(413, "payload too large")
+        if body:
+            try:
+                payload = orjson.loads(body)
+            except orjson.JSONDecodeError:
+                payload = {}
 
     # === User text ===
     user_text = get_user_text(payload).lower().strip()
 
     # === Commands ===
-    if user_text in ("help", "h", "?"):
-        return poe_reply(
-            "Beschikbare commando’s:\n"
-            "• account – status van je Alpaca paper account\n"
-            "• help – dit scherm\n"
-            "\nProtip: Als je ‘account’ krijgt met fout, check in Render of ALPACA_API_KEY/ALPACA_SECRET_KEY goed staan."
-        )
+    if not user_text:
+        return raw_json(_NO_TEXT_BODY)
 
-    if user_text.startswith("account"):
-        return poe_reply(alpaca_account_text())
+    handler = _ROUTES.get(user_text.split(None, 1)[0])
+    if handler:
+        return await handler(request)
 
-    if not user_text:
-        return poe_reply("Ik heb geen tekst ontvangen. Typ ‘help’ of ‘account’.")
-    else:
-        return poe_reply(f"Ik heb je bericht ontvangen: “{user_text}”. Typ ‘help’ voor opties.")
+    return raw_json(orjson.dumps(poe_reply(f"Ik heb je bericht ontvangen: “{user_text}”. Typ ‘help’ voor opties.")))
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    # Lokaal draaien; op Render via gunicorn (zie gunicorn.conf.py)
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=int(os.getenv("PORT") or 8000),
+        loop="uvloop",
+        http="httptools",
+        access_log=False,
+    )
@@ -0,0 +1,102 @@
+import asyncio
+
+import httpx
+import pytest
+
+import broker_alpaca
+
+
+@pytest.fixture(autouse=True)
+def _reset_cache():
+    broker_alpaca._cache.clear()
+    broker_alpaca._inflight.clear()
+    yield
+    broker_alpaca._cache.clear()
+    broker_alpaca._inflight.clear()
+
+
+def _client(handler):
+    return httpx.AsyncClient(base_url=broker_alpaca.BASE, transport=httpx.MockTransport(handler))
+
+
+def test_concurrent_misses_share_one_fetch():
+    calls = []
+
+    async def handler(request):
+        calls.append(request.url.path)
+        await asyncio.sleep(0.05)
+        return httpx.Response(200, json={"equity": "100"})
+
+    async def main():
+        async with _client(handler) as client:
+            return await asyncio.gather(*(broker_alpaca.account(client) for _ in range(10)))
+
+    results = asyncio.run(main())
+    assert len(calls) == 1
+    assert all(r == {"equity": "100"} for r in results)
+
+
+def test_failure_is_shared_with_all_waiters():
+    calls = []
+
+    async def handler(request):
+        calls.append(request.url.path)
+        await asyncio.sleep(0.05)
+        return httpx.Response(503, text="down")
+
+    async def main():
+        async with _client(handler) as client:
+            return await asyncio.gather(*(broker_alpaca.account(client) for _ in range(5)),
+                                        return_exceptions=True)
+
+    results = asyncio.run(main())
+    # één upstream call; elke wachter krijgt dezelfde fout i.p.v. zelf opnieuw in de rij te staan
+    assert len(calls) == 1
+    assert all(isinstance(r, httpx.HTTPStatusError) for r in results)
+    assert "/account" not in broker_alpaca._cache
+
+
+def test_fetch_started_before_order_does_not_repopulate_cache():
+    calls = []
+
+    async def handler(request):
+        calls.append((request.method, request.url.path))
+        if request.method == "POST":
+            return httpx.Response(200, json={"id": "o1"})
+        await asyncio.sleep(0.1)
+        return httpx.Response(200, json={"n": len(calls)})
+
+    async def main():
+        async with _client(handler) as client:
+            stale = asyncio.ensure_future(broker_alpaca.account(client))
+            await asyncio.sleep(0.02)
+            await broker_alpaca.market_order(client, symbol="AAPL", qty=1)
+            await stale
+            assert "/account" not in broker_alpaca._cache
+            return await broker_alpaca.account(client)
+
+    fresh = asyncio.run(main())
+    assert [c for c in calls if c[0] == "GET"] == [("GET", "/v2/account")] * 2
+    assert broker_alpaca._cache["/account"][1] == fresh
+
+
+def test_cancelled_waiter_does_not_cancel_shared_fetch():
+    calls = []
+
+    async def handler(request):
+        calls.append(request.url.path)
+        await asyncio.sleep(0.05)
+        return httpx.Response(200, json={"equity": "100"})
+
+    async def main():
+        async with _client(handler) as client:
+            first = asyncio.ensure_future(broker_alpaca.account(client))
+            second = asyncio.ensure_future(broker_alpaca.account(client))
+            await asyncio.sleep(0.01)
+            first.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await first
+            return await second
+
+    assert asyncio.run(main()) == {"equity": "100"}
+    assert len(calls) == 1